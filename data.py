@@ -5,7 +5,7 @@ import os
 
 from fake import FakeData
 
-__all__ = ['loaders']
+__all__ = ['loaders', 'distributed_loader']
 
 c10_classes = np.array([[0, 1, 2, 8, 9], [3, 4, 5, 6, 7]], dtype=np.int32)
 
@@ -235,3 +235,19 @@ def loaders(
     })
 
     return dl_dict, num_classes
+
+
+def distributed_loader(loader, shuffle=None):
+    # Same loader, but each process iterates over its own shard of the dataset.
+    #    shuffle=None keeps the shuffling of the original loader.
+    #    Call loader.sampler.set_epoch(epoch) every epoch to reshuffle the shards.
+    if shuffle is None:
+        shuffle = isinstance(loader.sampler, torch.utils.data.RandomSampler)
+    sampler = torch.utils.data.distributed.DistributedSampler(loader.dataset, shuffle=shuffle)
+    return torch.utils.data.DataLoader(
+        loader.dataset,
+        batch_size=loader.batch_size,
+        sampler=sampler,
+        num_workers=loader.num_workers,
+        pin_memory=True,
+    )
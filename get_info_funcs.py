@@ -1,7 +1,7 @@
 import torch
 import numpy as np
 from torch import nn
-from gpytorch.utils.lanczos import lanczos_tridiag
+from linear_operator.utils.lanczos import lanczos_tridiag
 from collections import defaultdict
 
 
@@ -84,9 +84,9 @@ def lanczos_tridiag_to_diag(t_mat):
     orig_device = t_mat.device
     
     if t_mat.size(-1) < 32:
-        retr = torch.symeig(t_mat.cpu(), eigenvectors=True)
+        retr = torch.linalg.eigh(t_mat.cpu())
     else:
-        retr = torch.symeig(t_mat, eigenvectors=True)
+        retr = torch.linalg.eigh(t_mat)
 
     evals, evecs = retr
     return evals.to(orig_device), evecs.to(orig_device)
@@ -7,7 +7,7 @@ def parser():
         '--gpu', 
         type=str,
         default='0',
-        help="GPU to use"
+        help="GPU to use (comma-separated list for distributed training with torchrun)"
     )
     
     parser.add_argument(
@@ -271,6 +271,24 @@ def parser():
         action="store_true", 
         help="SAM optimization"
     )
+    
+    parser.add_argument(
+        "--channels_last", 
+        action="store_true", 
+        help="use channels-last (NHWC) memory format for model and inputs"
+    )
+    
+    parser.add_argument(
+        "--bf16", 
+        action="store_true", 
+        help="run forward passes under BF16 autocast (needs a GPU with BF16 support)"
+    )
+    
+    parser.add_argument(
+        "--compile", 
+        action="store_true", 
+        help="torch.compile the loss and model forward used for training"
+    )
 
     args = parser.parse_args()
     return args
\ No newline at end of file
@@ -36,7 +36,16 @@ def main():
     os.environ['CUDA_DEVICE_ORDER']='PCI_BUS_ID'
     os.environ['CUDA_VISIBLE_DEVICES']=args.gpu
 
-    if torch.cuda.is_available():
+    # launched with torchrun: one process per GPU, --gpu should list all of them
+    args.distributed = "LOCAL_RANK" in os.environ
+
+    if args.distributed:
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.cuda.set_device(local_rank)
+        torch.distributed.init_process_group(backend="nccl")
+        args.device = torch.device("cuda", local_rank)
+        args.cuda = True
+    elif torch.cuda.is_available():
         args.device = torch.device("cuda")
         args.cuda = True
     else:
@@ -109,6 +118,9 @@ def main():
     model = model_cfg.base(*model_cfg.args, num_classes=num_classes, **model_cfg.kwargs,
                            **extra_args)
     model.to(args.device)
+    if args.channels_last:
+        # NHWC layout lets cuDNN pick tensor-core conv kernels
+        model.to(memory_format=torch.channels_last)
 
     
     param_groups = model.parameters()
@@ -151,7 +163,25 @@ def main():
         print(f"Fixing SI-pnorm to value {si_pnorm_0:.4f}")
 
 
+    if args.distributed:
+        # gradients are all-reduced in buckets, overlapped with the backward pass
+        model = torch.nn.parallel.DistributedDataParallel(model, 
+                                                          device_ids=[args.device.index], 
+                                                          bucket_cap_mb=25, 
+                                                          gradient_as_bucket_view=True)
+        loaders["train"] = data.distributed_loader(loaders["train"])
+
+    lrs = None
+    if not args.cosan_schedule:
+        lrs = lr_table(epoch_to, 
+                       lr_init=args.lr_init, 
+                       lr_schedule=not args.no_schedule, 
+                       c_schedule=args.c_schedule, 
+                       d_schedule=args.d_schedule)
+
     for epoch in range(epoch_from, epoch_to):
+        if args.distributed:
+            loaders["train"].sampler.set_epoch(epoch)
         train_epoch(model, loaders, cross_entropy, optimizer, 
                     epoch=epoch, 
                     end_epoch=epoch_to, 
@@ -159,38 +189,47 @@ def main():
                     save_freq=args.save_freq,
                     save_freq_int=args.save_freq_int,
                     output_dir=output_dir,
-                    lr_init=args.lr_init,
-                    lr_schedule=not args.no_schedule,
+                    lrs=lrs,
                     noninvlr=args.noninvlr,
-                    c_schedule=args.c_schedule,
-                    d_schedule=args.d_schedule,
                     si_pnorm_0=si_pnorm_0,
                     fbgd=args.fbgd,
                     cosan_schedule = args.cosan_schedule, 
-                    SAM=args.SAM)  
+                    SAM=args.SAM,
+                    channels_last=args.channels_last,
+                    bf16=args.bf16,
+                    compile_criterion=args.compile)  
         if args.cosan_schedule:
             scheduler.step()
     
+    training_utils.wait_for_checkpoints()
+    if args.distributed:
+        torch.distributed.destroy_process_group()
 
     print("model ", trial, " done")
 
 
+def lr_table(end_epoch, lr_init=0.01, lr_schedule=True, c_schedule=None, d_schedule=None):
+    "learning rates for all epochs, computed once before training"
+    epochs = np.arange(end_epoch)
+    if not lr_schedule:
+        return [float(lr_init)] * end_epoch
+    elif c_schedule is not None and c_schedule > 0:
+        return training_utils.c_schedule(epochs, lr_init, end_epoch, c_schedule)
+    elif d_schedule is not None and d_schedule > 0:
+        return training_utils.d_schedule(epochs, lr_init, end_epoch, d_schedule)
+    return training_utils.schedule(epochs, lr_init, end_epoch, swa=False)
+
+
 def train_epoch(model, loaders, criterion, optimizer, epoch, end_epoch,
-                eval_freq=1, save_freq=10, save_freq_int=0, output_dir='./', lr_init=0.01,
-                lr_schedule=True, noninvlr = -1, c_schedule=None, d_schedule=None, si_pnorm_0=None,fbgd=False, 
-               cosan_schedule = False, SAM=False):
+                eval_freq=1, save_freq=10, save_freq_int=0, output_dir='./', lrs=None,
+                noninvlr = -1, si_pnorm_0=None,fbgd=False, 
+               cosan_schedule = False, SAM=False, channels_last=False, compile_criterion=False,
+               bf16=False):
 
     time_ep = time.time()
 
     if not cosan_schedule:
-        if not lr_schedule:
-            lr = lr_init
-        elif c_schedule > 0:
-            lr = training_utils.c_schedule(epoch, lr_init, end_epoch, c_schedule)
-        elif d_schedule > 0:
-            lr = training_utils.d_schedule(epoch, lr_init, end_epoch, d_schedule)
-        else:
-            lr = training_utils.schedule(epoch, lr_init, end_epoch, swa=False)
+        lr = lrs[epoch]
         if noninvlr >= 0:
             training_utils.adjust_learning_rate_only_conv(optimizer, lr)
         else:
@@ -202,16 +241,20 @@ def train_epoch(model, loaders, criterion, optimizer, epoch, end_epoch,
 
     if not SAM:
         train_res = training_utils.train_epoch(loaders["train"], model, criterion, optimizer, fbgd=fbgd,si_pnorm_0=si_pnorm_0,
-                                           save_freq_int=save_freq_int,epoch = epoch,output_dir = output_dir)
+                                           save_freq_int=save_freq_int,epoch = epoch,output_dir = output_dir,
+                                           channels_last=channels_last, compile_criterion=compile_criterion,
+                                           bf16=bf16)
     else:
         train_res = training_utils.SAM_train_epoch(loaders["train"], model, criterion, optimizer, r=0.05, fbgd=fbgd,si_pnorm_0=si_pnorm_0,
-                                           save_freq_int=save_freq_int,epoch = epoch,output_dir = output_dir)
+                                           save_freq_int=save_freq_int,epoch = epoch,output_dir = output_dir,
+                                           channels_last=channels_last, compile_criterion=compile_criterion,
+                                           bf16=bf16)
     if (
         epoch == 0
         or epoch % eval_freq == eval_freq - 1
         or epoch == end_epoch - 1
     ):
-        test_res = training_utils.eval(loaders["test"], model, criterion)
+        test_res = training_utils.eval(loaders["test"], model, criterion, channels_last=channels_last, bf16=bf16)
     else:
         test_res = {"loss": None, "accuracy": None}
         
@@ -219,7 +262,7 @@ def train_epoch(model, loaders, criterion, optimizer, epoch, end_epoch,
         training_utils.save_checkpoint(
             output_dir,
             epoch,
-            state_dict=model.state_dict(),
+            state_dict=getattr(model, "module", model).state_dict(),
             optimizer=optimizer.state_dict(),
             train_res=train_res,
             test_res=test_res
@@ -248,7 +291,8 @@ def train_epoch(model, loaders, criterion, optimizer, epoch, end_epoch,
         table = "\n".join([table[1]] + table)
     else:
         table = table.split("\n")[2]
-    print(table)
+    if training_utils.is_main_process():
+        print(table)
 
 if __name__ == '__main__':
     main()
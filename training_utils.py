@@ -1,3 +1,4 @@
+import contextlib
 import itertools
 import torch
 import os
@@ -6,31 +7,82 @@ from datetime import datetime
 import math
 import numpy as np
 import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
+import torch.distributed as dist
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 
 def flatten(lst):
-    tmp = [i.contiguous().view(-1, 1) for i in lst]
-    return torch.cat(tmp).view(-1)
+    if len(lst) == 1:
+        # _flatten_dense_tensors returns a view for a single tensor, keep returning a copy
+        return lst[0].reshape(-1).clone()
+    return _flatten_dense_tensors([i.contiguous() for i in lst])
 
 
 def unflatten_like(vector, likeTensorList):
     # Takes a flat torch.tensor and unflattens it to a list of torch.tensors
     #    shaped like likeTensorList
-    outList = []
-    i = 0
-    for tensor in likeTensorList:
-        # n = module._parameters[name].numel()
-        n = tensor.numel()
-        outList.append(vector[:, i : i + n].view(tensor.shape))
-        i += n
-    return outList
+    return list(_unflatten_dense_tensors(vector.view(-1), likeTensorList))
 
 
 def LogSumExp(x, dim=0):
-    m, _ = torch.max(x, dim=dim, keepdim=True)
-    return m + torch.log((x - m).exp().sum(dim=dim, keepdim=True))
+    return torch.logsumexp(x, dim=dim, keepdim=True)
+
+
+def bf16_autocast(enabled=True):
+    "Run convolutions and matmuls in BF16 while keeping FP32 master weights"
+    return torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=enabled)
+
+
+class CUDAPrefetcher:
+    """
+        Wraps a DataLoader and copies the next batch to the GPU on a side stream
+        while the current batch is being processed.
+        The loader should use pin_memory=True for the copies to be asynchronous.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it):
+        try:
+            input, target = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            input = input.cuda(non_blocking=True)
+            target = target.cuda(non_blocking=True)
+        return input, target
+
+    def __iter__(self):
+        it = iter(self.loader)
+        batch = self._preload(it)
+        while batch is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_stream(self.stream)
+            input, target = batch
+            # tensors were allocated on the side stream but are used on the current one
+            input.record_stream(stream)
+            target.record_stream(stream)
+            batch = self._preload(it)
+            yield input, target
+
+
+_COMPILED_CRITERIA = {}
+
+def _compiled(criterion):
+    # compiled once per criterion, the model forward it calls is compiled along with it;
+    # no mode="reduce-overhead": CUDA graphs break when fix_si_pnorm/SAM rewrite weights between steps
+    if criterion not in _COMPILED_CRITERIA:
+        _COMPILED_CRITERIA[criterion] = torch.compile(criterion, mode="default", dynamic=False)
+    return _COMPILED_CRITERIA[criterion]
 
 
 def adjust_learning_rate(optimizer, lr):
@@ -76,51 +128,132 @@ def get_resnet_prebn_groups(g):
     return groups
 
 
+_REPORT_EPOCHS = None
+_REPORT_MAX_EPOCH = 20000
+
+def _build_report_set(max_epoch=_REPORT_MAX_EPOCH):
+    # (end epoch, step) pairs: all first 20 epochs, then every 5th up to 100, every 10th up to 200, ...
+    report_epochs = set()
+    start = 0
+    for end, step in [(20, 1), (100, 5), (200, 10), (1000, 50), (2000, 100), (10000, 500), (max_epoch, 1000)]:
+        report_epochs.update(range(start, end, step))
+        start = end
+    return report_epochs
+
+
 def do_report(epoch):
     # Only log activity for some epochs.  Mainly this is to make things run faster.
-    if epoch < 20:       # Log for all first 20 epochs
-        return True
-    elif epoch < 100:    # Then for every 5th epoch
-        return (epoch % 5 == 0)
-    elif epoch < 200:    # Then every 10th
-        return (epoch % 10 == 0)
-    elif epoch < 1000:    # Then every 50th
-        return (epoch % 50 == 0)
-    elif epoch < 2000:    # Then every 100th
-        return (epoch % 100 == 0)
-    elif epoch < 10000:    # Then every 500th
-        return (epoch % 500 == 0)
-    # Then every 1000th
-    return (epoch % 1000 == 0)
+    global _REPORT_EPOCHS
+    if epoch >= _REPORT_MAX_EPOCH:
+        # Then every 1000th
+        return (epoch % 1000 == 0)
+    if _REPORT_EPOCHS is None:
+        _REPORT_EPOCHS = _build_report_set()
+    return epoch in _REPORT_EPOCHS
+
+
+def get_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size()
+    return 1
+
+def is_main_process():
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
+def _sum_over_ranks(loss_sum, correct, num_objects):
+    # epoch metrics over the whole dataset: each DDP rank only saw its own shard
+    if get_world_size() == 1:
+        return loss_sum.item(), correct.item(), num_objects
+    stats = torch.stack([loss_sum, correct.to(loss_sum.dtype), loss_sum.new_tensor(num_objects)])
+    dist.all_reduce(stats)
+    loss_sum, correct, num_objects = stats.tolist()
+    return loss_sum, correct, int(num_objects)
+
+
+_CHECKPOINT_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+_pending_checkpoint = None
+
+def _to_cpu(obj):
+    # snapshot tensors (possibly nested in state dicts) so training can go on mutating them
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        out = type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            # state_dict version info used by load_state_dict
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+def _async_save(state, filepath):
+    # serialization and disk I/O run in a background thread, one save in flight at a time
+    global _pending_checkpoint
+    if not is_main_process():
+        # replicas hold the same weights, only rank 0 writes
+        return
+    state = _to_cpu(state)
+    wait_for_checkpoints()
+    _pending_checkpoint = _CHECKPOINT_EXECUTOR.submit(torch.save, state, filepath)
 
+def wait_for_checkpoints():
+    "Block until the last checkpoint is written (re-raises its error, if any)"
+    global _pending_checkpoint
+    if _pending_checkpoint is not None:
+        _pending_checkpoint.result()
+        _pending_checkpoint = None
 
 def save_checkpoint(dir, epoch, name="checkpoint", **kwargs):
     state = {"epoch": epoch}
     state.update(kwargs)
     filepath = os.path.join(dir, "%s-%d.pt" % (name, epoch))
-    torch.save(state, filepath)
+    _async_save(state, filepath)
     
 def save_checkpoint_int(dir, epoch, index, name="checkpoint", **kwargs):
     state = {"epoch": epoch,"index":index}
     state.update(kwargs)
     filepath = os.path.join(dir, "%s-%d-%d.pt" % (name, epoch,index))
-    torch.save(state, filepath)
+    _async_save(state, filepath)
     
 def load_checkpoint(dir, epoch, name="checkpoint"):
+    wait_for_checkpoints()
     filepath = os.path.join(dir, "%s-%d.pt" % (name, epoch))
     state = torch.load(filepath)
     return state
 
+def _get_si_params(model):
+    # conv params are looked up once and cached on the model itself
+    if not hasattr(model, "_si_conv_params"):
+        model._si_conv_params = [p for n, p in model.named_parameters() if "conv" in n]
+    return model._si_conv_params
+
+def _si_pnorm_sq(params):
+    # stays on device: one fused per-tensor norm kernel and one dot product
+    if not params:
+        # models without "conv" params, like the baseline's np.sqrt(sum([])) == 0.0
+        return torch.zeros(())
+    norms = torch.stack(torch._foreach_norm(params, 2))
+    return torch.dot(norms, norms)
+
+@torch.no_grad()
 def fix_si_pnorm(model, si_pnorm_0, model_name="ResNet18"):
     "Fix SI-pnorm to si_pnorm_0 value"
-    si_pnorm = np.sqrt(sum((p ** 2).sum().item() for n, p in model.named_parameters() if "conv" in n))
-    p_coef = si_pnorm_0 / si_pnorm
-    for n, p in model.named_parameters():
-        if "conv" in n:
-            p.data *= p_coef
-
+    params = _get_si_params(model)
+    if not params:
+        return
+    pnorm_sq = _si_pnorm_sq(params)
+    if get_world_size() > 1:
+        # DDP replicas may differ in the last bits, average so every rank applies the same coef
+        dist.all_reduce(pnorm_sq)
+        pnorm_sq /= get_world_size()
+    p_coef = si_pnorm_0 * torch.rsqrt(pnorm_sq)
+    torch._foreach_mul_(params, p_coef)
+
+@torch.no_grad()
 def get_si_params_norm(model):
-    si_pnorm = np.sqrt(sum((p ** 2).sum().item() for n, p in model.named_parameters() if "conv" in n))
+    si_pnorm = _si_pnorm_sq(_get_si_params(model)).sqrt().item()
     return si_pnorm
 
 
@@ -137,18 +270,31 @@ def train_epoch(
     save_freq_int = 0,
     epoch=None,
     output_dir = None,
-    si_pnorm_0 = None
+    si_pnorm_0 = None,
+    bf16=False,
+    channels_last=False,
+    compile_criterion=False
 ):
-    loss_sum = 0.0
-    correct = 0.0
+    # running sums stay on device and are synced only for logging
+    device = "cuda" if cuda else "cpu"
+    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
     verb_stage = 0
     save_ind = 0
 
     num_objects_current = 0
     num_batches = len(loader)
+    # fbgd: per-rank sums are averaged by DDP, so scale by the world size to get the full-batch mean
+    inv_dataset_len = get_world_size() / len(loader.dataset)
 
     model.train()
 
+    if compile_criterion:
+        criterion = _compiled(criterion)
+
+    if cuda:
+        loader = CUDAPrefetcher(loader)
+
     if subset is not None:
         num_batches = int(num_batches * subset)
         loader = itertools.islice(loader, num_batches)
@@ -157,32 +303,38 @@ def train_epoch(
         loader = tqdm.tqdm(loader, total=num_batches)
 
     reduction = "sum" if fbgd else "mean"
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
 
     for i, (input, target) in enumerate(loader):
-        if cuda:
-            input = input.cuda(non_blocking=True)
-            target = target.cuda(non_blocking=True)
+        if channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
 
-        loss, output = criterion(model, input, target, reduction)
+        with bf16_autocast(cuda and bf16):
+            loss, output = criterion(model, input, target, reduction)
 
         if fbgd:
-            loss_sum += loss.item()
-            loss /= len(loader.dataset)
-            loss.backward()
+            loss_sum += loss.detach()
+            loss = loss * inv_dataset_len
+            # under DDP gradients are accumulated locally and all-reduced on the last batch only
+            if isinstance(model, DistributedDataParallel) and i < num_batches - 1:
+                sync_context = model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+            with sync_context:
+                loss.backward()
         else:
             loss.backward()
             optimizer.step()
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             
             if si_pnorm_0 is not None:
                 fix_si_pnorm(model, si_pnorm_0)
                 
-            loss_sum += loss.data.item() * input.size(0)
+            loss_sum += loss.detach() * input.size(0)
 
         if not regression:
             pred = output.data.argmax(1, keepdim=True)
-            correct += pred.eq(target.data.view_as(pred)).sum().item()
+            correct += pred.eq(target.data.view_as(pred)).sum()
 
         num_objects_current += input.size(0)
 
@@ -191,8 +343,8 @@ def train_epoch(
                 "Stage %d/10. Loss: %12.4f. Acc: %6.2f"
                 % (
                     verb_stage + 1,
-                    loss_sum / num_objects_current,
-                    correct / num_objects_current * 100.0,
+                    loss_sum.item() / num_objects_current,
+                    correct.item() / num_objects_current * 100.0,
                 )
             )
             verb_stage += 1
@@ -202,7 +354,7 @@ def train_epoch(
                 output_dir,
                 epoch,
                 save_ind + 1,
-                state_dict=model.state_dict(),
+                state_dict=getattr(model, "module", model).state_dict(),
                 optimizer=optimizer.state_dict()
             )
             save_ind += 1
@@ -210,10 +362,12 @@ def train_epoch(
 
     if fbgd:
         optimizer.step()
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         
         if si_pnorm_0 is not None:
-            fix_si_pnorm(model, si_pnorm_0, model_name)
+            fix_si_pnorm(model, si_pnorm_0)
+
+    loss_sum, correct, num_objects_current = _sum_over_ranks(loss_sum, correct, num_objects_current)
 
     return {
         "loss": loss_sum / num_objects_current,
@@ -221,24 +375,113 @@ def train_epoch(
         "weights_norm" : get_si_params_norm(model)
     }
 
-def get_si_params_data(model):
-    grads = []
-    params = []
-    for n, p in model.named_parameters():
-        if "conv" in n:
-            grads.append(p.grad.data)
-            params.append(p.data)
+def _get_sam_params(model):
+    # SAM moves every param that gets a gradient; looked up after the first backward and cached.
+    # The mask marks SI (conv) params, whose grads are mixed with alpha
+    if not hasattr(model, "_sam_params"):
+        si_ids = {id(p) for p in _get_si_params(model)}
+        model._sam_params = [p for p in model.parameters() if p.grad is not None]
+        model._sam_si_mask = [id(p) in si_ids for p in model._sam_params]
+    return model._sam_params, model._sam_si_mask
+
+@torch.no_grad()
+def get_si_params_data(model, params=None, grads=None):
+    "Copy params and their grads into (pre-allocated) buffers"
+    sam_params, _ = _get_sam_params(model)
+    sam_grads = [p.grad for p in sam_params]
+    if params is None:
+        params = [torch.empty_like(p) for p in sam_params]
+        grads = [torch.empty_like(g) for g in sam_grads]
+    torch._foreach_copy_(params, sam_params)
+    torch._foreach_copy_(grads, sam_grads)
     return params, grads
 
+@torch.no_grad()
 def set_si_params_data(model, params, grads, alpha):
-    for i, (n, p) in enumerate(model.named_parameters()):
-        if "conv" in n:
-            p.data = params[i]
-            p.grad.data = (alpha) * p.grad.data + (1-alpha) * grads[i] 
-
+    "Restore params in place and mix current SI grads with the saved ones"
+    sam_params, si_mask = _get_sam_params(model)
+    torch._foreach_copy_(sam_params, params)
+    si_grads = [p.grad for p, si in zip(sam_params, si_mask) if si]
+    saved_si_grads = [g for g, si in zip(grads, si_mask) if si]
+    if si_grads:
+        torch._foreach_mul_(si_grads, alpha)
+        torch._foreach_add_(si_grads, saved_si_grads, alpha=1 - alpha)
+
+@torch.no_grad()
 def update_si_params_data(model, grad_norm, r):
-    for i, param in enumerate(model.parameters()):
-        param.data = param.data + r * param.grad.data / grad_norm
+    "Move params to w+r*grad/||grad||, grads are scaled in place (save them first)"
+    sam_params, _ = _get_sam_params(model)
+    sam_grads = [p.grad for p in sam_params]
+    torch._foreach_mul_(sam_grads, r / grad_norm)
+    torch._foreach_add_(sam_params, sam_grads)
+
+
+@torch.no_grad()
+def sam_step(model, criterion, input, target, r, alpha=1.0, fbgd=False, loss_scale=None,
+             params=None, grads=None, bf16=False):
+    """
+        Both SAM passes for one batch, without the optimizer step.
+        Computes the gradient at w, moves params to w+r*grad/||grad||, computes the gradient
+        there and goes back to w with the SI grads mixed as alpha*new + (1-alpha)*old.
+        With fbgd the mixed gradient of this batch, scaled by loss_scale, is added to the
+        full-batch gradient accumulated in .grad.
+        :param loss_scale: factor for the batch gradient before accumulation (fbgd)
+        :param params, grads: buffers returned by the previous call, allocated if None
+        :return: loss and output of the second forward, buffers for the next call
+    """
+    reduction = "sum" if fbgd else "mean"
+
+    if fbgd:
+        # set the full-batch gradient aside, both passes below need this batch's gradient only
+        acc_params = [p for p in model.parameters() if p.grad is not None]
+        if isinstance(model, DistributedDataParallel) and getattr(model, "gradient_as_bucket_view", False):
+            # bucket-view grads are reused by the next backward, keep a copy
+            acc_grads = [p.grad.clone() for p in acc_params]
+            model.zero_grad(set_to_none=True)
+        else:
+            acc_grads = [p.grad for p in acc_params]
+            for p in acc_params:
+                p.grad = None
+
+    # first forward and backward at w
+    with torch.enable_grad():
+        with bf16_autocast(bf16):
+            loss, output = criterion(model, input, target, reduction)
+        loss.backward()
+
+    # save grad and weights
+    params, grads = get_si_params_data(model, params, grads)
+    # find norm_grad
+    grad_norm = _si_pnorm_sq(grads).sqrt()
+    # update weights to w+r*grad/||grad||
+    update_si_params_data(model, grad_norm, r)
+    # second backward should give the gradient at w+r*grad/||grad|| only
+    model.zero_grad(set_to_none=True)
+
+    # second forward and backward at w+r*grad/||grad||
+    with torch.enable_grad():
+        with bf16_autocast(bf16):
+            loss, output = criterion(model, input, target, reduction)
+        if loss_scale is not None:
+            (loss * loss_scale).backward()
+        else:
+            loss.backward()
+
+    if loss_scale is not None:
+        # the saved gradient is mixed in with the same scale as the second one
+        torch._foreach_mul_(grads, loss_scale)
+
+    # back to w weights
+    set_si_params_data(model, params, grads, alpha)
+
+    if fbgd:
+        for p, acc_grad in zip(acc_params, acc_grads):
+            if p.grad is None:
+                p.grad = acc_grad
+            else:
+                p.grad.add_(acc_grad)
+
+    return loss.detach(), output.detach(), params, grads
 
 
 def SAM_train_epoch(
@@ -256,18 +499,31 @@ def SAM_train_epoch(
     save_freq_int = 0,
     epoch=None,
     output_dir = None,
-    si_pnorm_0 = None
+    si_pnorm_0 = None,
+    bf16=False,
+    channels_last=False,
+    compile_criterion=False
 ):
-    loss_sum = 0.0
-    correct = 0.0
+    # running sums stay on device and are synced only for logging
+    device = "cuda" if cuda else "cpu"
+    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
     verb_stage = 0
     save_ind = 0
 
     num_objects_current = 0
     num_batches = len(loader)
+    # fbgd: per-rank sums are averaged by DDP, so scale by the world size to get the full-batch mean
+    inv_dataset_len = get_world_size() / len(loader.dataset)
 
     model.train()
 
+    if compile_criterion:
+        criterion = _compiled(criterion)
+
+    if cuda:
+        loader = CUDAPrefetcher(loader)
+
     if subset is not None:
         num_batches = int(num_batches * subset)
         loader = itertools.islice(loader, num_batches)
@@ -275,60 +531,40 @@ def SAM_train_epoch(
     if verbose:
         loader = tqdm.tqdm(loader, total=num_batches)
 
-    reduction = "sum" if fbgd else "mean"
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
+    # buffers for the SI params and grads at w, allocated on the first batch
+    params, grads = None, None
 
     for i, (input, target) in enumerate(loader):
-        if cuda:
-            input = input.cuda(non_blocking=True)
-            target = target.cuda(non_blocking=True)
+        if channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
+
+        loss, output, params, grads = sam_step(
+            model, criterion, input, target, r,
+            alpha=alpha,
+            fbgd=fbgd,
+            loss_scale=inv_dataset_len if fbgd else None,
+            params=params,
+            grads=grads,
+            bf16=cuda and bf16
+        )
 
-        ### TODO: when we SI NORMALIZE
-        # first forward
-        loss, output = criterion(model, input, target, reduction)
-
-        # TODO: save loss after second forward
-        loss.backward()
-
-        # get grad and weights
-        params, grads = get_params_data(model)
-        # find norm_grad
-        grad_norm = torch.norm(torch.cat([i.flatten() for i in grads]).clone().detach())
-        # update weights to w+r*grad/||grad||
-        update_si_params_data(model, grad_norm, r)
-        
-        # TODO: should we scale ???
-        #if si_pnorm_0 is not None:
-        #    fix_si_pnorm(model, si_pnorm_0, model_name)
-        
-
-        # second forward
-        loss, output = criterion(model, input, target, reduction)
-
-        # TODO: save loss after second forward
         if fbgd:
-            loss_sum += loss.item()
-            loss /= len(loader.dataset)
-            loss.backward()
+            loss_sum += loss
         else:
-            # second backward, find new gradient
-            loss.backward()
-            loss_sum += loss.data.item() * input.size(0)
+            loss_sum += loss * input.size(0)
 
-        # back to w weights
-        set_si_params_data(model, params, grads, alpha)
-        
         # do step for w weights with SAM direction
         if not fbgd:
             optimizer.step()
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
 
             if si_pnorm_0 is not None:
                 fix_si_pnorm(model, si_pnorm_0)
 
         if not regression:
             pred = output.data.argmax(1, keepdim=True)
-            correct += pred.eq(target.data.view_as(pred)).sum().item()
+            correct += pred.eq(target.data.view_as(pred)).sum()
 
         num_objects_current += input.size(0)
 
@@ -337,8 +573,8 @@ def SAM_train_epoch(
                 "Stage %d/10. Loss: %12.4f. Acc: %6.2f"
                 % (
                     verb_stage + 1,
-                    loss_sum / num_objects_current,
-                    correct / num_objects_current * 100.0,
+                    loss_sum.item() / num_objects_current,
+                    correct.item() / num_objects_current * 100.0,
                 )
             )
             verb_stage += 1
@@ -348,7 +584,7 @@ def SAM_train_epoch(
                 output_dir,
                 epoch,
                 save_ind + 1,
-                state_dict=model.state_dict(),
+                state_dict=getattr(model, "module", model).state_dict(),
                 optimizer=optimizer.state_dict()
             )
             save_ind += 1
@@ -356,10 +592,12 @@ def SAM_train_epoch(
 
     if fbgd:
         optimizer.step()
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         
         if si_pnorm_0 is not None:
-            fix_si_pnorm(model, si_pnorm_0, model_name)
+            fix_si_pnorm(model, si_pnorm_0)
+
+    loss_sum, correct, num_objects_current = _sum_over_ranks(loss_sum, correct, num_objects_current)
 
     return {
         "loss": loss_sum / num_objects_current,
@@ -369,38 +607,48 @@ def SAM_train_epoch(
 
 
 
-def eval(loader, model, criterion, cuda=True, regression=False, verbose=False):
-    loss_sum = 0.0
-    correct = 0.0
+def eval(loader, model, criterion, cuda=True, regression=False, verbose=False, bf16=False,
+         channels_last=False):
+    device = "cuda" if cuda else "cpu"
+    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
     num_objects_total = len(loader.dataset)
 
     model.eval()
 
     with torch.no_grad():
+        if cuda:
+            loader = CUDAPrefetcher(loader)
         if verbose:
             loader = tqdm.tqdm(loader)
         for i, (input, target) in enumerate(loader):
-            if cuda:
-                input = input.cuda(non_blocking=True)
-                target = target.cuda(non_blocking=True)
+            if channels_last:
+                input = input.contiguous(memory_format=torch.channels_last)
 
-            loss, output = criterion(model, input, target)
+            with bf16_autocast(cuda and bf16):
+                loss, output = criterion(model, input, target)
 
-            loss_sum += loss.item() * input.size(0)
+            loss_sum += loss.detach() * input.size(0)
 
             if not regression:
                 pred = output.data.argmax(1, keepdim=True)
-                correct += pred.eq(target.data.view_as(pred)).sum().item()
+                correct += pred.eq(target.data.view_as(pred)).sum()
 
     return {
-        "loss": loss_sum / num_objects_total,
-        "accuracy": None if regression else correct / num_objects_total * 100.0,
+        "loss": loss_sum.item() / num_objects_total,
+        "accuracy": None if regression else correct.item() / num_objects_total * 100.0,
     }
 
 
-def predict(loader, model, verbose=False):
-    predictions = list()
-    targets = list()
+def _empty_like_dataset(num_objects, batch, pin_memory=False):
+    # host buffer for outputs over the whole dataset, filled slice by slice
+    return torch.empty((num_objects,) + tuple(batch.shape[1:]), dtype=batch.dtype, pin_memory=pin_memory)
+
+
+def predict(loader, model, verbose=False, bf16=False):
+    predictions = None
+    targets = None
+    num_objects = len(loader.dataset)
 
     model.eval()
 
@@ -411,20 +659,30 @@ def predict(loader, model, verbose=False):
     with torch.no_grad():
         for input, target in loader:
             input = input.cuda(non_blocking=True)
-            output = model(input)
+            with bf16_autocast(bf16):
+                output = model(input)
+            probs = F.softmax(output.float(), dim=1)
+
+            if predictions is None:
+                predictions = _empty_like_dataset(num_objects, probs, pin_memory=True)
+                targets = _empty_like_dataset(num_objects, target)
 
             batch_size = input.size(0)
-            predictions.append(F.softmax(output, dim=1).cpu().numpy())
-            targets.append(target.numpy())
+            # copies into pinned memory do not block, synchronized once below
+            predictions[offset : offset + batch_size].copy_(probs, non_blocking=True)
+            targets[offset : offset + batch_size] = target
             offset += batch_size
 
-    return {"predictions": np.vstack(predictions), "targets": np.concatenate(targets)}
+    torch.cuda.synchronize()
+    return {"predictions": predictions[:offset].numpy(), "targets": targets[:offset].numpy()}
 
 
+@torch.no_grad()
 def moving_average(net1, net2, alpha=1):
-    for param1, param2 in zip(net1.parameters(), net2.parameters()):
-        param1.data *= 1.0 - alpha
-        param1.data += param2.data * alpha
+    params1 = list(net1.parameters())
+    params2 = list(net2.parameters())
+    torch._foreach_mul_(params1, 1.0 - alpha)
+    torch._foreach_add_(params1, params2, alpha=alpha)
 
 
 def _check_bn(module, flag):
@@ -440,8 +698,8 @@ def check_bn(model):
 
 def reset_bn(module):
     if issubclass(module.__class__, torch.nn.modules.batchnorm._BatchNorm):
-        module.running_mean = torch.zeros_like(module.running_mean)
-        module.running_var = torch.ones_like(module.running_var)
+        module.running_mean.zero_()
+        module.running_var.fill_(1.0)
 
 
 def _get_momenta(module, momenta):
@@ -468,6 +726,7 @@ def bn_update(loader, model, verbose=False, subset=None, **kwargs):
     momenta = {}
     model.apply(reset_bn)
     model.apply(lambda module: _get_momenta(module, momenta))
+    bn_modules = list(momenta.keys())
     n = 0
     num_batches = len(loader)
 
@@ -483,8 +742,9 @@ def bn_update(loader, model, verbose=False, subset=None, **kwargs):
             input_var = torch.autograd.Variable(input)
             b = input_var.data.size(0)
 
+            # b / (n + b) makes the running stats an exact cumulative average over batches
             momentum = b / (n + b)
-            for module in momenta.keys():
+            for module in bn_modules:
                 module.momentum = momentum
 
             model(input_var, **kwargs)
@@ -500,52 +760,46 @@ def inv_softmax(x, eps=1e-10):
 def predictions(test_loader, model, seed=None, cuda=True, regression=False, **kwargs):
     # will assume that model is already in eval mode
     # model.eval()
-    preds = []
-    targets = []
+    preds = None
+    targets = None
+    num_objects = len(test_loader.dataset)
+    offset = 0
     for input, target in test_loader:
         if seed is not None:
             torch.manual_seed(seed)
         if cuda:
             input = input.cuda(non_blocking=True)
-        output = model(input, **kwargs)
-        if regression:
-            preds.append(output.cpu().data.numpy())
-        else:
-            probs = F.softmax(output, dim=1)
-            preds.append(probs.cpu().data.numpy())
-        targets.append(target.numpy())
-    return np.vstack(preds), np.concatenate(targets)
+        output = model(input, **kwargs).detach()
+        if not regression:
+            output = F.softmax(output, dim=1)
+        if preds is None:
+            preds = _empty_like_dataset(num_objects, output, pin_memory=cuda)
+            targets = _empty_like_dataset(num_objects, target)
+        batch_size = input.size(0)
+        preds[offset : offset + batch_size].copy_(output, non_blocking=True)
+        targets[offset : offset + batch_size] = target
+        offset += batch_size
+    if cuda:
+        torch.cuda.synchronize()
+    return preds[:offset].numpy(), targets[:offset].numpy()
 
 
 def schedule(epoch, lr_init, epochs, swa, swa_start=None, swa_lr=None):
-    t = (epoch) / (swa_start if swa else epochs)
+    # epoch may be an array of epochs to get the whole lr table at once;
+    # .tolist() gives plain python floats so no numpy scalars end up in optimizer/checkpoints
+    t = np.asarray(epoch) / (swa_start if swa else epochs)
     lr_ratio = swa_lr / lr_init if swa else 0.01
-    if t <= 0.5:
-        factor = 1.0
-    elif t <= 0.9:
-        factor = 1.0 - (1.0 - lr_ratio) * (t - 0.5) / 0.4
-    else:
-        factor = lr_ratio
-    return lr_init * factor
+    factor = 1.0 - (1.0 - lr_ratio) * np.clip((t - 0.5) / 0.4, 0.0, 1.0)
+    return (lr_init * factor).tolist()
 
 def d_schedule(epoch, lr_init, epochs, p):
     # discrete schedule - decrease lr x times after each 1/4 epochs
-    t = epoch / epochs
-    if t <= 0.25:
-        factor = 1.0
-    elif t <= 0.5:
-        factor = 1.0/p
-    elif t <= 0.75:
-        factor = 1.0/p/p
-    else:
-        factor = 1.0/p/p/p
-    return lr_init * factor
+    t = np.asarray(epoch) / epochs
+    factor = float(p) ** -np.clip(np.ceil(4 * t) - 1, 0, 3)
+    return (lr_init * factor).tolist()
 
 def c_schedule(epoch, lr_init, epochs, p):
     # continuous schedule - decrease lr linearly after 1/4 epochs so that at the end it is x times lower 
-    t = epoch / epochs
-    if t <= 0.25:
-        factor = 1.0
-    else:
-        factor = 1.0/p+(1-1.0/p)*(1-t)/0.75
-    return lr_init * factor
+    t = np.asarray(epoch) / epochs
+    factor = 1.0/p+(1-1.0/p)*np.minimum(1.0, (1-t)/0.75)
+    return (lr_init * factor).tolist()